@@ -5,13 +5,119 @@ from elvm import *
 import argparse
 from collections import defaultdict
 import sys
-from typing import List
+from typing import Dict, List, Tuple
 
 
-def compileToEir(code: str) -> str:
+EVAL_STEP_LIMIT = 100000
+
+
+def matchBrackets(code: str) -> Dict[int, int]:
+    matches: Dict[int, int] = {}
+    loopStarts: List[int] = []
+
+    for i, c in enumerate(code):
+        if c == "[":
+            loopStarts.append(i)
+        elif c == "]":
+            if not loopStarts:
+                raise Exception("Unmatched ]")
+            loopStart = loopStarts.pop()
+            matches[loopStart] = i
+            matches[i] = loopStart
+
+    if loopStarts:
+        raise Exception("Unmatched [")
+
+    return matches
+
+
+# Runs the program at compile time until it first reads input or ends. If the
+# step budget runs out first, evaluation carries on to the next ".", "[" or "]",
+# since those are the only other places the compiled code can be resumed from.
+# Returns the index to resume at, the output so far, the tape and the pointer.
+def evaluatePrefix(
+    code: str, matches: Dict[int, int], maxSteps: int
+) -> Tuple[int, List[int], List[int], int]:
+    output: List[int] = []
+    tape = [0]
+    ptr = 0
+    pc = 0
+    steps = 0
+
+    while pc < len(code):
+        c = code[pc]
+        if c == "," or (steps >= maxSteps and c in ".[]"):
+            break
+        elif c == ">":
+            ptr += 1
+            if ptr == len(tape):
+                tape.append(0)
+        elif c == "<":
+            if ptr == 0:
+                tape.insert(0, 0)
+            else:
+                ptr -= 1
+        elif c == "+":
+            tape[ptr] = (tape[ptr] + 1) % 256
+        elif c == "-":
+            tape[ptr] = (tape[ptr] - 1) % 256
+        elif c == ".":
+            output.append(tape[ptr])
+        elif c == "[":
+            if tape[ptr] == 0:
+                pc = matches[pc]
+        elif c == "]":
+            if tape[ptr] != 0:
+                pc = matches[pc]
+        if c in "<>+-.[]":
+            steps += 1
+        pc += 1
+
+    return pc, output, tape, ptr
+
+
+def generatePrint(module: Module, output: List[int]) -> None:
+    outputLabel = module.addData(output)
+    module.addInstruction(Op.MOV, Register.B, outputLabel)
+    module.addInstruction(Op.MOV, Register.C, outputLabel)
+    module.addInstruction(Op.ADD, Register.C, len(output))
+    loopStart = module.addInstruction(Op.LOAD, Register.D, Register.B)
+    module.addInstruction(Op.PUTC, src=Register.D)
+    module.addInstruction(Op.ADD, Register.B, 1)
+    module.addInstruction(
+        Op.JNE, Register.B, Register.C, loopStart.getLabel(module)
+    )
+
+
+def compileToEir(code: str, maxSteps: int = EVAL_STEP_LIMIT) -> str:
     module = Module()
 
-    module.addInstruction(Op.MOV, Register.A, 1)
+    matches = matchBrackets(code)
+    resumeIndex, output, tape, ptr = evaluatePrefix(code, matches, maxSteps)
+
+    if resumeIndex == len(code):
+        if output:
+            generatePrint(module, output)
+        module.addInstruction(Op.EXIT)
+        return module.compile()
+
+    # When resuming, the tape has to be the only data, so the output is
+    # printed with immediates instead
+    for char in output:
+        module.addInstruction(Op.PUTC, src=char)
+
+    jmpToResume = None
+    if resumeIndex == 0:
+        module.addInstruction(Op.MOV, Register.A, 1)
+    else:
+        # As the only data, the tape starts at address 0 and has a spare cell
+        # to its left, like the tape starting at address 1 without evaluation.
+        # Moving left of it wraps around to zeroed memory, and the untouched
+        # cells past its end are still zero
+        tapeLabel = module.addData([0] + tape)
+        module.addInstruction(Op.MOV, Register.A, tapeLabel)
+        module.addInstruction(Op.ADD, Register.A, ptr + 1)
+        jmpToResume = module.addInstruction(Op.JMP)
 
     changes: Dict[int, int] = defaultdict(int)
     curMove = 0
@@ -38,7 +144,7 @@ def compileToEir(code: str) -> str:
             module.addInstruction(Op.ADD, Register.A, curMove - lastMove)
         changes.clear()
 
-    for c in code:
+    for i, c in enumerate(code):
         if c == ">":
             curMove += 1
         elif c == "<":
@@ -47,35 +153,30 @@ def compileToEir(code: str) -> str:
             changes[curMove] += 1
         elif c == "-":
             changes[curMove] -= 1
-        elif c == ".":
-            pushChanges()
-            curMove = 0
-            module.addInstruction(Op.LOAD, Register.B, Register.A)
-            module.addInstruction(Op.PUTC, src=Register.B)
-        elif c == ",":
-            pushChanges()
-            curMove = 0
-            module.addInstruction(Op.GETC, Register.B)
-            module.addInstruction(Op.STORE, Register.A, Register.B)
-        elif c == "[":
+        elif c in ".,[]":
             pushChanges()
             curMove = 0
-            module.addInstruction(Op.LOAD, Register.B, Register.A)
-            loopStarts.append(module.addInstruction(Op.JEQ, Register.B, 0))
-        elif c == "]":
-            pushChanges()
-            curMove = 0
-            if not loopStarts:
-                raise Exception("Unmatched ]")
-            loopStart = loopStarts.pop()
-            module.addInstruction(Op.LOAD, Register.B, Register.A)
-            loopEnd = module.addInstruction(
-                Op.JNE, Register.B, 0, loopStart.getLabel(module)
-            )
-            loopStart.jmp = Value(loopEnd.getLabel(module))
-
-    if loopStarts:
-        raise Exception("Unmatched [")
+            # The pointer is in register A and the tape is fully up to date
+            # here, so this is where compile-time evaluation can hand over
+            commandStart = len(module.insts)
+            if c == ".":
+                module.addInstruction(Op.LOAD, Register.B, Register.A)
+                module.addInstruction(Op.PUTC, src=Register.B)
+            elif c == ",":
+                module.addInstruction(Op.GETC, Register.B)
+                module.addInstruction(Op.STORE, Register.A, Register.B)
+            elif c == "[":
+                module.addInstruction(Op.LOAD, Register.B, Register.A)
+                loopStarts.append(module.addInstruction(Op.JEQ, Register.B, 0))
+            elif c == "]":
+                loopStart = loopStarts.pop()
+                module.addInstruction(Op.LOAD, Register.B, Register.A)
+                loopEnd = module.addInstruction(
+                    Op.JNE, Register.B, 0, loopStart.getLabel(module)
+                )
+                loopStart.jmp = Value(loopEnd.getLabel(module))
+            if jmpToResume is not None and i == resumeIndex:
+                jmpToResume.jmp = Value(module.insts[commandStart].getLabel(module))
 
     module.addInstruction(Op.EXIT)
 
@@ -96,13 +197,21 @@ def main() -> int:
         type=str,
         help="The file to write the compiled EIR to",
     )
+    parser.add_argument(
+        "--eval-steps",
+        dest="evalSteps",
+        type=int,
+        default=EVAL_STEP_LIMIT,
+        help="The number of brainfuck commands to run at compile time before "
+        "the first input read",
+    )
 
     args = parser.parse_args()
 
     inFile = open(args.inFile, "r") if args.inFile else sys.stdin
     outFile = open(args.outFile, "w") if args.outFile else sys.stdout
 
-    outFile.write(compileToEir(inFile.read()))
+    outFile.write(compileToEir(inFile.read(), args.evalSteps))
 
 
 if __name__ == "__main__":